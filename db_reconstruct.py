@@ -4,158 +4,302 @@
 # Reconstruct tomograms during pipeline processing
 # This script will be passed the data processing parameters by the main shell script 
 
+import argparse
 import contextlib
+from dataclasses import asdict, dataclass
+import functools
 import os
 from pathlib import Path
-import sys
+import string
 import subprocess
+import sys
+import threading
 import time
-from typing import Generator
+from typing import Any, Callable, Generator
+
+import numpy as np
+
+try:
+    from watchdog.events import PatternMatchingEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    # Fall back to polling for the mdoc if watchdog is unavailable
+    Observer = None
+
+
+IO_BUFFER = 1 << 20  # Buffer size for file reads, in bytes
+
+# Keys of interest in the mdoc
+MDOC_KEYS = ('TiltAngle', 'Defocus', 'Magnification', 'PixelSpacing')
+
+# Templates for the batchruntomo com and directive (adoc) files
+_BRT_COM = string.Template(
+    '$$batchruntomo -StandardInput\n'
+    'NamingStyle     1\n'
+    'MakeSubDirectory\n'
+    'CPUMachineList  localhost:$cpus\n'
+    'GPUMachineList  $gpus\n'
+    'NiceValue       15\n'
+    'EtomoDebug      0\n'
+    'DirectiveFile   $master_adoc\n'
+    'CurrentLocation $out_dir\n'
+    'BypassEtomo\n'
+)
+_ADOC_BASE = string.Template(
+    'setupset.systemTemplate = /usr/local/IMOD/SystemTemplate/cryoSample.adoc\n'
+    'runtime.Preprocessing.any.removeXrays = $remove_xrays\n'
+    'comparam.prenewst.newstack.BinByFactor = $prealign_bin\n'
+    'runtime.Fiducials.any.trackingMethod = $track_method\n'
+    'setupset.copyarg.gold = $size_gold\n'
+    'runtime.AlignedStack.any.binByFactor = $final_bin\n'
+    'runtime.Reconstruction.any.useSirt = $do_sirt\n'
+    'runtime.Trimvol.any.scaleFromZ = \n'
+    'runtime.Postprocess.any.doTrimvol = $do_trimvol\n'
+    'setupset.copyarg.pixel = $pixel_size\n'
+    'setupset.copyarg.rotation = $tiltaxis\n'
+    'setupset.copyarg.dosesym = $dose_sym\n'
+    'setupset.copyarg.voltage = $voltage\n'
+    'setupset.copyarg.Cs = $cs\n'
+    'comparam.prenewst.newstack.AntialiasFilter = 4\n'
+    'comparam.newst.newstack.AntialiasFilter = 4\n'
+    'runtime.Trimvol.any.reorient = $reorient\n'
+    'comparam.tilt.tilt.THICKNESS = $thickness_unbinned\n'
+)
+_ADOC_FIDUCIAL = string.Template(
+    'runtime.Fiducials.any.seedingMethod = 1\n'
+    'comparam.track.beadtrack.SobelFilterCentering = $use_sobel\n'
+    'comparam.autofidseed.autofidseed.TargetNumberOfBeads = $num_beads\n'
+)
+_ADOC_SOBEL = string.Template(
+    'comparam.track.beadtrack.KernelSigmaForSobel = $sobel_sigma\n'
+)
+_ADOC_PATCH = string.Template(
+    'comparam.xcorr_pt.tiltxcorr.SizeOfPatchesXandY = $patch_size_x,$patch_size_y\n'
+    'comparam.xcorr_pt.tiltxcorr.OverlapOfPatchesXandY = $patch_overlap_x,$patch_overlap_y\n'
+)
+_ADOC_CTF = string.Template(
+    'runtime.AlignedStack.any.correctCTF = $do_ctf\n'
+    'comparam.ctfplotter.ctfplotter.ScanDefocusRange = $defocus_min,$defocus_max\n'
+    'runtime.CTFplotting.any.autoFitRangeAndStep = $autofit_range,$autofit_step\n'
+    'comparam.ctfplotter.ctfplotter.BaselineFittingOrder = 4\n'
+    'comparam.ctfplotter.ctfplotter.SearchAstigmatism = 1\n'
+)
+_ADOC_SIRT_TAIL = string.Template(
+    'comparam.tilt.tilt.FakeSIRTiterations = $fake_sirt_iters'
+)
+
+
+@dataclass(slots=True)
+class BRTArgs:
+    """ Pipeline arguments for batchruntomo, as passed from the shell script """
+    cpus: int
+    gpus: str
+    out_dir: Path
+    read_mdoc: int
+    remove_xrays: int
+    prealign_bin: int
+    track_method: int
+    size_gold: float
+    final_bin: int
+    do_sirt: int
+    do_trimvol: int
+    pixel_size: float | None
+    tiltaxis: str
+    dose_sym: int
+    voltage: int
+    cs: float
+    reorient: int
+    thickness_binned: int | None
+    thickness_unbinned: int | None
+    use_sobel: int
+    num_beads: int
+    sobel_sigma: float
+    patch_size: list[int]
+    patch_overlap: list[float]
+    do_ctf: int
+    defocus_range: list[float]
+    autofit_range: float
+    autofit_step: float
+    tune_fitting_sample: int
+    fake_sirt_iters: int
+    use_inotify: bool = True
+
 
+def optional(type_: type) -> Callable[[str], Any]:
+    """ Argument type which maps "EMPTY" from the shell script to None """
+    def convert(value: str) -> Any:
+        return None if value == 'EMPTY' else type_(value)
+    return convert
 
-def setup_serieswatcher(**kwargs) -> tuple[Path, Path]:
+
+def parse_args(argv: list[str] | None = None) -> BRTArgs:
+    """ Parse the positional pipeline arguments passed by the shell script """
+    parser = argparse.ArgumentParser(description='Reconstruct tomograms during pipeline processing')
+    parser.add_argument('cpus', type=int)
+    parser.add_argument('gpus')
+    parser.add_argument('out_dir', type=Path)
+    parser.add_argument('read_mdoc', type=int)
+    parser.add_argument('remove_xrays', type=int)
+    parser.add_argument('prealign_bin', type=int)
+    parser.add_argument('track_method', type=int)
+    parser.add_argument('size_gold', type=float)
+    parser.add_argument('final_bin', type=int)
+    parser.add_argument('do_sirt', type=int)
+    parser.add_argument('do_trimvol', type=int)
+    parser.add_argument('pixel_size', type=optional(float))
+    parser.add_argument('tiltaxis')
+    parser.add_argument('dose_sym', type=int)
+    parser.add_argument('voltage', type=int)
+    parser.add_argument('cs', type=float)
+    parser.add_argument('reorient', type=int)
+    parser.add_argument('thickness_binned', type=optional(int))
+    parser.add_argument('thickness_unbinned', type=optional(int))
+    parser.add_argument('use_sobel', type=int)
+    parser.add_argument('num_beads', type=int)
+    parser.add_argument('sobel_sigma', type=float)
+    parser.add_argument('patch_size', type=int, nargs=2)
+    parser.add_argument('patch_overlap', type=float, nargs=2)
+    parser.add_argument('do_ctf', type=int)
+    parser.add_argument('defocus_range', type=float, nargs=2)
+    parser.add_argument('autofit_range', type=float)
+    parser.add_argument('autofit_step', type=float)
+    parser.add_argument('tune_fitting_sample', type=int)
+    parser.add_argument('fake_sirt_iters', type=int)
+    # Use a filesystem watch for the mdoc unless told otherwise (e.g. on non-Linux hosts)
+    parser.add_argument('--no-inotify', dest='use_inotify', action='store_false')
+
+    args = BRTArgs(**vars(parser.parse_args(argv)))
+    # The unbinned thickness is only used when no binned thickness is given
+    if args.thickness_binned is None and args.thickness_unbinned is None:
+        parser.error('one of thickness_binned or thickness_unbinned must be given, not both EMPTY')
+    args.out_dir = Path.cwd() / args.out_dir
+    return args
+
+
+def setup_serieswatcher(args: BRTArgs) -> tuple[Path, Path]:
     """
     Construct the COM and ADOC files to to run serieswatcher
 
-    :param: **kwargs
+    :param: BRTArgs args
         Pipeline arguments passed from shell script
 
     :return: tuple of files
         master com file, master adoc file
     """
-    assert 'cpus' in kwargs
-    assert 'gpus' in kwargs
-    assert 'out_dir' in kwargs
-    assert 'remove_xrays' in kwargs
-    assert 'read_mdoc' in kwargs
-    assert 'remove_xrays' in kwargs
-    assert 'prealign_bin' in kwargs
-    assert 'track_method' in kwargs
-    assert 'size_gold' in kwargs
-    assert 'final_bin' in kwargs
-    assert 'do_sirt' in kwargs
-    assert 'do_trimvol' in kwargs
-    assert 'pixel_size' in kwargs
-    assert 'tiltaxis' in kwargs
-    assert 'dose_sym' in kwargs
-    assert 'voltage' in kwargs
-    assert 'cs' in kwargs
-    assert 'reorient' in kwargs
-    assert 'thickness_binned' in kwargs
-    assert 'thickness_unbinned' in kwargs
-    assert 'use_sobel' in kwargs
-    assert 'num_beads' in kwargs
-    assert 'sobel_sigma' in kwargs
-    assert 'patch_size' in kwargs
-    assert 'patch_overlap' in kwargs
-    assert 'do_ctf' in kwargs
-    assert 'defocus_range'  in kwargs
-    assert 'autofit_range'  in kwargs
-    assert 'autofit_step' in kwargs
-    assert 'tune_fitting_sample' in kwargs
-    assert 'fake_sirt_iters' in kwargs
-
     # Get those parameters which can be read from the mdoc - pixel size, exposure, tilt angles
-    mdoc_info = read_mdoc(get_mdoc(kwargs['out_dir']))
+    mdoc_info = read_mdoc(get_mdoc(args.out_dir, args.use_inotify))
 
     master_com = Path.cwd() / Path('coms/BRT_MASTER.com')
     master_com.parent.mkdir(parents=True, exist_ok=True)
     master_adoc = Path.cwd() / Path('coms/BRT_MASTER.adoc')
     master_adoc.parent.mkdir(parents=True, exist_ok=True)
 
-    if kwargs['pixel_size'] == "EMPTY":
-        kwargs['pixel_size'] == mdoc_info['Pixel Size']
-    if kwargs['thickness_binned'] != "EMPTY":
-        kwargs['thickness_unbinned'] = str(
-            int(kwargs['thickness_binned']) * int(kwargs['final_bin'])
-        )
+    if args.pixel_size is None:
+        args.pixel_size = float(mdoc_info['Pixel Size'])
+    if args.thickness_binned is not None:
+        args.thickness_unbinned = args.thickness_binned * args.final_bin
+
+    # Values substituted into the com and adoc templates
+    values = {
+        **asdict(args),
+        'master_adoc': master_adoc,
+        'patch_size_x': args.patch_size[0],
+        'patch_size_y': args.patch_size[1],
+        'patch_overlap_x': args.patch_overlap[0],
+        'patch_overlap_y': args.patch_overlap[1],
+        'defocus_min': args.defocus_range[0],
+        'defocus_max': args.defocus_range[1],
+    }
 
     # Construct the com file
-    master_com.write_text(
-        '$batchruntomo -StandardInput\n'
-        'NamingStyle     1\n'
-        'MakeSubDirectory\n'
-        f'CPUMachineList  localhost:{kwargs["cpus"]}\n'
-        f'GPUMachineList  {kwargs["gpus"]}\n'
-        'NiceValue       15\n'
-        'EtomoDebug      0\n'
-        f'DirectiveFile   {master_adoc}\n'
-        f'CurrentLocation {kwargs["out_dir"]}\n'
-        'BypassEtomo\n'
-    )
+    master_com.write_text(_BRT_COM.substitute(values))
     
-    # Construct the adoc file
-    master_adoc.write_text(
-        'setupset.systemTemplate = /usr/local/IMOD/SystemTemplate/cryoSample.adoc\n'
-        f'runtime.Preprocessing.any.removeXrays = {kwargs["remove_xrays"]}\n'
-        f'comparam.prenewst.newstack.BinByFactor = {kwargs["prealign_bin"]}\n'
-        f'runtime.Fiducials.any.trackingMethod = {kwargs["track_method"]}\n'
-        f'setupset.copyarg.gold = {kwargs["size_gold"]}\n'
-        f'runtime.AlignedStack.any.binByFactor = {kwargs["final_bin"]}\n'
-        f'runtime.Reconstruction.any.useSirt = {kwargs["do_sirt"]}\n'
-        'runtime.Trimvol.any.scaleFromZ = \n'
-        f'runtime.Postprocess.any.doTrimvol = {kwargs["do_trimvol"]}\n'
-        f'setupset.copyarg.pixel = {kwargs["pixel_size"]}\n'
-        f'setupset.copyarg.rotation = {kwargs["tiltaxis"]}\n'
-        f'setupset.copyarg.dosesym = {kwargs["dose_sym"]}\n'
-        f'setupset.copyarg.voltage = {kwargs["voltage"]}\n'
-        f'setupset.copyarg.Cs = {kwargs["cs"]}\n'
-        'comparam.prenewst.newstack.AntialiasFilter = 4\n'
-        'comparam.newst.newstack.AntialiasFilter = 4\n'
-        f'runtime.Trimvol.any.reorient = {kwargs["reorient"]}\n'
-        f'comparam.tilt.tilt.THICKNESS = {kwargs["thickness_unbinned"]}\n'
-    )
-
-    if int(kwargs['track_method']) == 0:
+    # Construct the adoc file from the fragments for the chosen options
+    fragments = [_ADOC_BASE]
+    if args.track_method == 0:
         # Fiducial tracking
-        with master_adoc.open("a") as f:
-            f.write(
-                'runtime.Fiducials.any.seedingMethod = 1\n'
-                f'comparam.track.beadtrack.SobelFilterCentering = {kwargs["use_sobel"]}\n'
-                f'comparam.autofidseed.autofidseed.TargetNumberOfBeads = {kwargs["num_beads"]}\n'
-            )
-        
-        if int(kwargs['use_sobel']) == 1:
-            with master_adoc.open("a") as f:
-                f.write(
-                    f'comparam.track.beadtrack.KernelSigmaForSobel = {kwargs["sobel_sigma"]}\n'
-                )
-    elif int(kwargs['track_method']) == 1:
+        fragments.append(_ADOC_FIDUCIAL)
+        if args.use_sobel == 1:
+            fragments.append(_ADOC_SOBEL)
+    elif args.track_method == 1:
         # Patch tracking
-        with master_adoc.open("a") as f:
-            f.write(
-                f'comparam.xcorr_pt.tiltxcorr.SizeOfPatchesXandY = {kwargs["patch_size"][0]},{kwargs["patch_size"][1]}\n'
-                f'comparam.xcorr_pt.tiltxcorr.OverlapOfPatchesXandY = {kwargs["patch_overlap"][0]},{kwargs["patch_overlap"][1]}\n'
-            )
+        fragments.append(_ADOC_PATCH)
     else:
-        raise ValueError(f"Tracking method of {kwargs['track_method']} is not supported")
+        raise ValueError(f"Tracking method of {args.track_method} is not supported")
     
-    if int(kwargs['do_ctf']) == 1:
-        with master_adoc.open("a") as f:
-            f.write(
-                f'runtime.AlignedStack.any.correctCTF = {kwargs["do_ctf"]}\n'
-                f'comparam.ctfplotter.ctfplotter.ScanDefocusRange = {kwargs["defocus_range"][0]},{kwargs["defocus_range"][1]}\n'
-                f'runtime.CTFplotting.any.autoFitRangeAndStep = {kwargs["autofit_range"]},{kwargs["autofit_step"]}\n'
-                'comparam.ctfplotter.ctfplotter.BaselineFittingOrder = 4\n'
-                'comparam.ctfplotter.ctfplotter.SearchAstigmatism = 1\n'
-            )
-
-    if int(kwargs['do_sirt']) == 0:
-        with master_adoc.open("a") as f:
-            f.write(
-                f'comparam.tilt.tilt.FakeSIRTiterations = {kwargs["fake_sirt_iters"]}'
-            )
+    if args.do_ctf == 1:
+        fragments.append(_ADOC_CTF)
+
+    if args.do_sirt == 0:
+        fragments.append(_ADOC_SIRT_TAIL)
+
+    parts = [t.substitute(values) for t in fragments]
+    master_adoc.write_text(''.join(parts))
             
     return master_com, master_adoc
 
-def get_mdoc(p: Path) -> Path:
-    """ Get mdoc files for each processing directory """
-    while True: 
-        mdocs = [x for x in list(p.rglob('*.mdoc'))]
-        if mdocs:
-            break
-        time.sleep(60)
-    return mdocs[0]
+def _wait_until_written(mdoc: Path, interval: float = 1.0) -> Path:
+    """ Wait until the mdoc is non-empty and its size has stopped changing """
+    size = -1
+    while (new_size := mdoc.stat().st_size) == 0 or new_size != size:
+        size = new_size
+        time.sleep(interval)
+    return mdoc
+
+
+def get_mdoc(p: Path, use_inotify: bool = True) -> Path:
+    """ 
+    Get mdoc files for each processing directory 
+    
+    Blocks on a filesystem watch until an mdoc appears and has been written, unless
+    watchdog is unavailable, the host is not Linux (no close events from inotify),
+    the directory does not exist yet or use_inotify is False, in which case the
+    directory is polled every 60 s
+    """
+    if (mdoc := next(p.rglob('*.mdoc'), None)) is not None:
+        return _wait_until_written(mdoc)
+
+    if (not use_inotify or Observer is None or not sys.platform.startswith('linux')
+            or not p.is_dir()):
+        while True: 
+            time.sleep(60)
+            if (mdoc := next(p.rglob('*.mdoc'), None)) is not None:
+                return _wait_until_written(mdoc)
+
+    found = threading.Event()
+    mdocs = []
+
+    class MdocHandler(PatternMatchingEventHandler):
+        def on_created(self, event):
+            # Also fired for a rename into the tree from elsewhere, which has no close
+            mdocs.append(Path(event.src_path))
+            found.set()
+
+        def on_closed(self, event):
+            mdocs.append(Path(event.src_path))
+            found.set()
+
+        def on_moved(self, event):
+            # Moves match if either path does, so only accept a move onto an mdoc
+            if event.dest_path.endswith('.mdoc'):
+                mdocs.append(Path(event.dest_path))
+                found.set()
+
+    observer = Observer()
+    observer.schedule(
+        MdocHandler(patterns=['*.mdoc'], ignore_directories=True), str(p), recursive=True
+    )
+    observer.start()
+    try:
+        # Catch an mdoc written between the first check and the watch starting
+        if (mdoc := next(p.rglob('*.mdoc'), None)) is not None:
+            return _wait_until_written(mdoc)
+        found.wait()
+    finally:
+        observer.stop()
+        observer.join()
+    # A created file may still be empty, so wait for the writer to finish
+    return _wait_until_written(mdocs[0])
 
 
 def read_mdoc(mdoc: Path) -> dict[str, any]:
@@ -174,40 +318,53 @@ def read_mdoc(mdoc: Path) -> dict[str, any]:
         "tilt max": [float] tilt_max
         "tilt increment": [int] tilt increment
     }
+
+    Results are cached on the file's path, modification time and size, so an
+    unchanged mdoc is only parsed once
     """
     assert mdoc.exists()
+    st = mdoc.stat()
+    # Copy the lists too so callers can't mutate the cached entry
+    info = dict(_read_mdoc_cached(mdoc, st.st_mtime_ns, st.st_size))
+    info['Tilt Angles'] = list(info['Tilt Angles'])
+    info['Defocus'] = list(info['Defocus'])
+    return info
+
 
+@functools.lru_cache(maxsize=128)
+def _read_mdoc_cached(mdoc: Path, mtime: int, size: int) -> dict[str, any]:
+    """ Parse the mdoc. mtime and size are only part of the cache key """
+    tilts = []
+    defocus = []
     header_info = {}
-    # Open each file and extract the relevant information
-    with open(mdoc, 'r') as f:
-        header_info['Tilt Angles'] = []
-        header_info['Defocus'] = []
+    # Open each file and extract the relevant information in a single pass
+    with open(mdoc, 'r', buffering=IO_BUFFER) as f:
         for line in f:
-            strip_line = line.rstrip()
-            if 'TiltAngle' in strip_line:
-                index = strip_line.find('=')
-                angle = round(float(strip_line[index+2:]))
-                header_info['Tilt Angles'].append(angle)
-            if 'Defocus' in strip_line and 'Target' not in strip_line:
-                index = strip_line.find('=')
-                header_info['Defocus'].append(float(strip_line[index+2:]))
-            if 'Magnification' in strip_line:
-                index = strip_line.find('=')
-                header_info['Magnification'] = strip_line[index+2:]
-            if 'PixelSpacing' in strip_line:
-                index = strip_line.find('=')
-                header_info['Pixel Size'] = str(round(float(strip_line[index+2:]),2)/10)
-
-    header_info['Tilt Min'] = min(header_info['Tilt Angles'])
-    header_info['Tilt Max'] = max(header_info['Tilt Angles'])
+            key, eq, val = line.partition('=')
+            if not eq:
+                continue
+            if not key.startswith(MDOC_KEYS):
+                continue
+            val = val.strip()
+            if key.startswith('TiltAngle'):
+                tilts.append(round(float(val)))
+            elif key.startswith('Defocus'):
+                defocus.append(float(val))
+            elif key.startswith('Magnification'):
+                header_info['Magnification'] = val
+            elif key.startswith('PixelSpacing'):
+                header_info['Pixel Size'] = str(round(float(val), 2)/10)
+
+    header_info['Tilt Angles'] = tilts
+    header_info['Defocus'] = defocus
+
+    ta = np.asarray(tilts)
+    header_info['Tilt Min'] = int(ta.min())
+    header_info['Tilt Max'] = int(ta.max())
     header_info['Tilt Step'] = round(abs(
-        (header_info['Tilt Max'] - header_info['Tilt Min'])
-        / len(header_info['Tilt Angles'])
-    )) 
-    header_info['Defocus Avg'] = round(
-        sum(header_info['Defocus']) / float(
-            len(header_info['Defocus'])
-        ), 2)
+        (header_info['Tilt Max'] - header_info['Tilt Min']) / ta.size
+    ))
+    header_info['Defocus Avg'] = round(float(np.asarray(defocus).mean()), 2)
     
     return header_info
 
@@ -223,49 +380,12 @@ def chdir(path: str | Path) -> Generator[None, None, None]:
         os.chdir(prev_cwd)
     
 
-if len(sys.argv) < 34:
-    raise ValueError("Not enough arguments passed to DB_RECONSTRUCT")
-
-pipeline_args = {
-    'cpus': sys.argv[1], 
-    'gpus': sys.argv[2],
-    'out_dir': sys.argv[3], 
-    'read_mdoc': sys.argv[4], 
-    'remove_xrays': sys.argv[5],
-    'prealign_bin': sys.argv[6],
-    'track_method': sys.argv[7], 
-    'size_gold': sys.argv[8],
-    'final_bin': sys.argv[9], 
-    'do_sirt': sys.argv[10],
-    'do_trimvol': sys.argv[11], 
-    'pixel_size': sys.argv[12], 
-    'tiltaxis': sys.argv[13],
-    'dose_sym': sys.argv[14], 
-    'voltage': sys.argv[15], 
-    'cs': sys.argv[16], 
-    'reorient': sys.argv[17], 
-    'thickness_binned': sys.argv[18], 
-    'thickness_unbinned': sys.argv[19],
-    'use_sobel': sys.argv[20],
-    'num_beads': sys.argv[21],
-    'sobel_sigma': sys.argv[22],
-    'patch_size': [sys.argv[23], sys.argv[24]],
-    'patch_overlap': [sys.argv[25], sys.argv[26]],
-    'do_ctf': sys.argv[27],
-    'defocus_range': [sys.argv[28], sys.argv[29]],
-    'autofit_range': sys.argv[30],
-    'autofit_step': sys.argv[31],
-    'tune_fitting_sample': sys.argv[32],
-    'fake_sirt_iters': sys.argv[33]
-}
-assert 'out_dir' in pipeline_args
-pipeline_args['out_dir'] = Path.cwd() / Path(pipeline_args['out_dir'])
-
-print(pipeline_args)
-
-com, adoc = setup_serieswatcher(**pipeline_args)
+args = parse_args()
+print(args)
+
+com, adoc = setup_serieswatcher(args)
 brt_pipeline = "brt_pipeline"
-with chdir(pipeline_args['out_dir']):
+with chdir(args.out_dir):
     # cmd = f'tmux new-session -d -s {brt_pipeline}'
     # subprocess.run(cmd, shell=True)
 
@@ -13,22 +13,26 @@
 # Constructing tilt file may really need to first be copied from the OG tilt file - 
 # there are some specifics that should be kept the same as the OG tilt file
 
-import contextlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
 import os
 from pathlib import Path
 import sys
 import subprocess
+import threading
 import time
 from typing import Generator
 
 import mrcfile
+import numpy as np
 
 
 DB_DIR = '/root/cloud-data/its-cmo-darwin-magellan-workspaces-folders/WS_Cryoem/CX_LMR/Project_directories/cryo-et-data'
 EXT = '*_rec.mrc'  # Suffix of completed tomogram
 BIN = 6  # Bin factor
 GPU = 0  # Number GPU device - 0 for best
+IO_BUFFER = 1 << 20  # Buffer size for com file reads and writes, in bytes
 
 # Setup the logger
 logging.basicConfig(
@@ -44,23 +48,15 @@ formatter = logging.Formatter(
     datefmt="%Y-%m-%d %H:%M"
 )
 
-@contextlib.contextmanager
-def chdir(path: str | Path) -> Generator[None, None, None]:
-    """ Changed working directory and returns to the previous on exit """
-    prev_cwd = Path.cwd()
-    os.chdir(path)
-    try:
-        yield
-    finally:
-        os.chdir(prev_cwd)
-
 
 def get_datasets(p: str | Path) -> list[Path]:
     """ Get all the datasets in the given directory for half set generation """
-    return [x for x in p.iterdir() if x.is_dir() and list(x.glob(EXT))]
+    with os.scandir(p) as it:
+        dirs = [Path(e.path) for e in it if e.is_dir(follow_symlinks=False)]
+    return [x for x in dirs if next(x.glob(EXT), None) is not None]
 
 
-def check_metadata(dataset: Path) -> int:
+def check_metadata(dataset: Path, name: str) -> int:
     """ 
     Check the metadata required for generation of half sets 
     
@@ -70,12 +66,22 @@ def check_metadata(dataset: Path) -> int:
         2 - partial metadata, need to run both newstack and tilt
     """
     db_set = dataset.name.split('/')[0]
-    name = [x for x in dataset.glob('*_rec.mrc') if 'full' not in x.name][0].name.split('_rec')[0]
-    
-    xf = list(dataset.glob(f'{name}.xf'))
-    ali = list(dataset.glob(f'{name}_ali.mrc'))
-    tlt = list(dataset.glob(f'{name}.tlt'))
-    xtilt = list(dataset.glob(f'{name}.xtilt'))
+
+    # Read the directory once rather than globbing for each file
+    xf_name, ali_name = f'{name}.xf', f'{name}_ali.mrc'
+    tlt_name, xtilt_name = f'{name}.tlt', f'{name}.xtilt'
+    xf = ali = tlt = xtilt = False
+    with os.scandir(dataset) as it:
+        for entry in it:
+            n = entry.name
+            if n == xf_name:
+                xf = True
+            elif n == ali_name:
+                ali = True
+            elif n == tlt_name:
+                tlt = True
+            elif n == xtilt_name:
+                xtilt = True
 
     if (not xf and not ali) or not tlt or not xtilt:
         logger.info('Not enough metadata for dataset %s - %s' % (db_set, name))
@@ -95,10 +101,12 @@ def check_metadata(dataset: Path) -> int:
     return 0
 
 
-def construct_coms(dataset: Path, status: int) -> None:
+def construct_coms(dataset: Path, status: int, name: str) -> None:
     """ Construct the newstack.com and tilt.com files """
-    name = [x for x in dataset.glob('*_rec.mrc') if 'full' not in x.name][0].name.split('_rec')[0]
-    mdoc = list(dataset.glob(f'{name}*.mdoc'))[0]
+    with os.scandir(dataset) as it:
+        mdoc = next(
+            Path(e.path) for e in it if e.name.startswith(name) and e.name.endswith('.mdoc')
+        )
 
     logger.info('Identified MDOC file %s' % mdoc.name)
 
@@ -131,44 +139,41 @@ def construct_coms(dataset: Path, status: int) -> None:
     tilt_com = dataset / Path('tilt.com')
     tilt_evens = dataset / Path('tilt_evens.com')
     tilt_odds = dataset / Path('tilt_odds.com')
-    
-    if tilt_evens.exists():
-       tilt_evens.unlink()
-    if tilt_odds.exists():
-        tilt_odds.unlink() 
-
 
     mrc = dataset / Path(f'{name}.mrc')
     rec = dataset / Path(f'{name}_rec.mrc')
 
-    with mrcfile.open(mrc) as f:
+    # Only the header is needed, so skip reading the voxel data
+    with mrcfile.open(mrc, header_only=True) as f:
         full_mage_size = [f.header.nx, f.header.ny, f.header.nz]
         pix = f.voxel_size
         if round(pix.x.item(), 2) == round(pix.y.item(), 2) == round(pix.z.item(), 2):
             mrc_pix = round(pix.x.item(), 2)
-    with mrcfile.open(rec) as f:
+    with mrcfile.open(rec, header_only=True) as f:
         rec_image_size = [f.header.nx, f.header.ny, f.header.nz]
         pix = f.voxel_size
         if round(pix.x.item(), 2) == round(pix.y.item(), 2) == round(pix.z.item(), 2):
             rec_pix = round(pix.x.item(), 2)
 
-    evens = f'INCLUDE {",".join(str(i+1) for i in range(full_mage_size[2]) if i % 2 == 0)}'
-    odds = f'INCLUDE {",".join(str(i+1) for i in range(full_mage_size[2]) if i % 2 == 1)}'
+    # 1-based section numbers, split into alternating tilts
+    idx = np.arange(1, full_mage_size[2] + 1)
+    evens = f'INCLUDE {",".join(idx[::2].astype(str))}'
+    odds = f'INCLUDE {",".join(idx[1::2].astype(str))}'
 
     # Write the files based on the preexisting tilt.com
     if tilt_com.exists():
         logger.info('Creating tilt coms based off of existing com files.')
-        with tilt_com.open('r') as f:
+        with (
+            tilt_com.open('r', buffering=IO_BUFFER) as f, 
+            tilt_evens.open('w', buffering=IO_BUFFER) as te, 
+            tilt_odds.open('w', buffering=IO_BUFFER) as to
+        ):
             for line in f:
                 if 'InputProjections' in line:
                     line = f'InputProjections {name}_ali.mrc\n'
                 if 'OutputFile' in line:
-                    with tilt_evens.open('a') as t:
-                        line = f'OutputFile	{name}_full_rec_evens.mrc\n'
-                        t.write(line)
-                    with tilt_odds.open('a') as t:
-                        line = f'OutputFile	{name}_full_rec_odds.mrc\n'
-                        t.write(line)
+                    te.write(f'OutputFile	{name}_full_rec_evens.mrc\n')
+                    to.write(f'OutputFile	{name}_full_rec_odds.mrc\n')
                     continue
                 if 'IMAGEBINNED' in line:
                     line = f'IMAGEBINNED	{BIN}\n'
@@ -179,15 +184,11 @@ def construct_coms(dataset: Path, status: int) -> None:
                 if 'useGPU' in line:
                     line = f'UseGPU	    {GPU}\n'
 
-                with tilt_evens.open('a') as t:
-                    t.write(line)
-                with tilt_odds.open('a') as t:
-                    t.write(line)
+                te.write(line)
+                to.write(line)
             
-        with tilt_evens.open('a') as f:
-            f.write(f'{evens}')
-        with tilt_odds.open('a') as f:
-            f.write(f'{odds}')
+            te.write(evens)
+            to.write(odds)
     else:
         logger.info('Creating brand new tilt com files.')
         rec_bin = full_mage_size[0] // rec_image_size[0]
@@ -240,7 +241,36 @@ def construct_coms(dataset: Path, status: int) -> None:
         )
 
 
-def newstack(dataset: Path) -> bool:
+def run_command(cmd: str, cwd: Path) -> tuple[bool, bool]:
+    """
+    Run an IMOD command, streaming its output to the logger as it runs
+
+    :param str cmd: Command to run
+    :param Path cwd: Directory to run the command in
+
+    :return tuple(bool, bool): Whether 'finished successfully' and 'ERROR' appeared in the output
+    """
+    finished = errored = False
+    with subprocess.Popen(
+        cmd, 
+        shell=True, 
+        cwd=cwd, 
+        stdout=subprocess.PIPE, 
+        stderr=subprocess.STDOUT, 
+        text=True, 
+        bufsize=1
+    ) as proc:
+        for line in proc.stdout:
+            logger.debug(line.rstrip())
+            if 'finished successfully' in line:
+                finished = True
+            if 'ERROR' in line:
+                errored = True
+        proc.wait()
+    return finished, errored
+
+
+def newstack(dataset: Path, name: str) -> bool:
     """ 
     Run newstack on a dataset with its newst.com file
      
@@ -249,32 +279,30 @@ def newstack(dataset: Path) -> bool:
         False if error  
      """
     db_set = dataset.name.split('/')[0]
-    name = [x for x in dataset.glob('*_rec.mrc') if 'full' not in x.name][0].name.split('_rec')[0]
 
     cmd = 'subm newst.com'
-    with chdir(dataset):
+    logger.info(
+        'Beginning newstack to generate aligned stack for dataset %s -- %s'
+        % (db_set, name)
+    )
+
+    finished, errored = run_command(cmd, dataset)
+    if finished:
         logger.info(
-            'Beginning newstack to generate aligned stack for dataset %s -- %s'
+            '%s -- Successfully generated aligned stack %s_ali.mrc'
             % (db_set, name)
         )
-
-        out = subprocess.run(cmd, shell=True, capture_output=True, encoding='utf-8')
-        if 'finished successfully' in out.stdout:
-            logger.info(
-                '%s -- Successfully generated aligned stack %s_ali.mrc'
-                % (db_set, name)
-            )
-            return True
-        elif 'ERROR' in out.stdout:
-            logger.error(
-                '%s -- Error in generating aligned stack'
-                % db_set
-            )
-            return False
+        return True
+    elif errored:
+        logger.error(
+            '%s -- Error in generating aligned stack'
+            % db_set
+        )
         return False
+    return False
 
 
-def tilt(dataset: Path) -> bool:
+def tilt(dataset: Path, name: str) -> bool:
     """ 
     Run tilt on a dataset to generate half tomos with its tilt.com files
 
@@ -283,53 +311,50 @@ def tilt(dataset: Path) -> bool:
         False is error 
      """
     db_set = dataset.name.split('/')[0]
-    name = [x for x in dataset.glob('*_rec.mrc') if 'full' not in x.name][0].name.split('_rec')[0]
-    
-    with chdir(dataset):
 
-        cmd = 'subm tilt_evens.com'
+    cmd = 'subm tilt_evens.com'
+    logger.info(
+        'tilt - Begining generation of tomogram from even tilts for dataset %s -- %s'
+        % (db_set, name)
+    )
+    finished, errored = run_command(cmd, dataset)
+
+    success = 0
+    if finished:
         logger.info(
-            'tilt - Begining generation of tomogram from even tilts for dataset %s -- %s'
-            % (db_set, name)
+            '%s -- Successfully generated even tilt tomogram'
+            % db_set
         )
-        out = subprocess.run(cmd, shell=True, capture_output=True, encoding='utf-8')
-
-        success = 0
-        if 'finished successfully' in out.stdout:
-            logger.info(
-                '%s -- Successfully generated even tilt tomogram'
-                % db_set
-            )
-            success += 1
-        elif 'ERROR' in out.stdout:
-            logger.error(
-                '%s -- Error in generating even tilt tomogram'
-                % db_set
-            )
-
-        cmd = 'subm tilt_odds.com'
-        logger.info(
-            'tilt - Begining generation of tomogram from odd tilts for dataset %s -- %s'
-            % (db_set, name)
+        success += 1
+    elif errored:
+        logger.error(
+            '%s -- Error in generating even tilt tomogram'
+            % db_set
         )
-        out = subprocess.run(cmd, shell=True, capture_output=True, encoding='utf-8')
 
-        if 'finished successfully' in out.stdout:
-            logger.info(
-                '%s -- Successfully generated odd tilt tomogram'
-                % db_set
-            )
-            success += 1
-        elif 'ERROR' in out.stdout:
-            logger.error(
-                '%s -- Error in generating odd tilt tomogram'
-                % db_set
-            )
+    cmd = 'subm tilt_odds.com'
+    logger.info(
+        'tilt - Begining generation of tomogram from odd tilts for dataset %s -- %s'
+        % (db_set, name)
+    )
+    finished, errored = run_command(cmd, dataset)
+
+    if finished:
+        logger.info(
+            '%s -- Successfully generated odd tilt tomogram'
+            % db_set
+        )
+        success += 1
+    elif errored:
+        logger.error(
+            '%s -- Error in generating odd tilt tomogram'
+            % db_set
+        )
 
-        return True if success == 2 else False
+    return True if success == 2 else False
 
 
-def trimvol(dataset: Path) -> bool:
+def trimvol(dataset: Path, name: str) -> bool:
     """ 
     Run trimvol on a dataset to rotate the final tomogram
     
@@ -338,114 +363,166 @@ def trimvol(dataset: Path) -> bool:
         False if error
     """
     db_set = dataset.name.split('/')[0]
-    name = [x for x in dataset.glob('*_rec.mrc')if 'full' not in x.name][0].name.split('_rec')[0]
-    with chdir(dataset):
-        full_rec_evens = f'{name}_full_rec_evens.mrc'
-        rec_evens = f'{name}_rec_evens.mrc'
-        full_rec_odds = f'{name}_full_rec_odds.mrc'
-        rec_odds = f'{name}_rec_odds.mrc'
-
-        cmd = f'trimvol -rx {full_rec_evens} {rec_evens}'
+    full_rec_evens = f'{name}_full_rec_evens.mrc'
+    rec_evens = f'{name}_rec_evens.mrc'
+    full_rec_odds = f'{name}_full_rec_odds.mrc'
+    rec_odds = f'{name}_rec_odds.mrc'
+
+    cmd = f'trimvol -rx {full_rec_evens} {rec_evens}'
+    logger.info(
+        'trimvol - rotating evens tilt dataset %s -- %s around the X axis'
+        % (db_set, name)
+    )
+    finished, errored = run_command(cmd, dataset)
+    
+    success = 0
+    if finished:
         logger.info(
-            'trimvol - rotating evens tilt dataset %s -- %s around the X axis'
-            % (db_set, name)
+            '%s -- Successfully rotated even tilt tomogram'
+            % db_set
         )
-        out = subprocess.run(cmd, shell=True, capture_output=True, encoding='utf-8')
-        
-        success = 0
-        if 'finished successfully' in out.stdout:
-            logger.info(
-                '%s -- Successfully rotated even tilt tomogram'
-                % db_set
-            )
-            success += 1
-        elif 'ERROR' in out.stdout:
-            logger.error(
-                '%s -- Error in rotating even tilt tomogram'
-                % db_set
-            )
-
-        cmd = f'trimvol -rx {full_rec_odds} {rec_odds}'
+        success += 1
+    elif errored:
+        logger.error(
+            '%s -- Error in rotating even tilt tomogram'
+            % db_set
+        )
+
+    cmd = f'trimvol -rx {full_rec_odds} {rec_odds}'
+    logger.info(
+        'trimvol - rotating odds tilt dataset %s -- %s around the X axis'
+        % (db_set, name)
+    )
+    finished, errored = run_command(cmd, dataset)
+
+    if finished:
         logger.info(
-            'trimvol - rotating odds tilt dataset %s -- %s around the X axis'
-            % (db_set, name)
+            '%s -- Successfully rotated odd tilt tomogram'
+            % db_set
         )
-        out = subprocess.run(cmd, shell=True, capture_output=True, encoding='utf-8')
+        success += 1
+    elif errored:
+        logger.error(
+            '%s -- Error in rotating odd tilt tomogram'
+            % db_set
+        )
+
+    return True if success == 2 else False
 
-        if 'finished successfully' in out.stdout:
-            logger.info(
-                '%s -- Successfully rotated odd tilt tomogram'
-                % db_set
-            )
-            success += 1
-        elif 'ERROR' in out.stdout:
-            logger.error(
-                '%s -- Error in rotating odd tilt tomogram'
-                % db_set
-            )
 
-        return True if success == 2 else False
+def process_dataset(
+        d: Path, 
+        name: str, 
+        prog: int, 
+        gpu_sema: threading.BoundedSemaphore
+    ) -> bool:
+    """
+    Run newstack, tilt and trimvol on a single dataset
+
+    :param Path d: Dataset directory
+    :param str name: Basename of the tilt series
+    :param int prog: Metadata status from check_metadata
+    :param BoundedSemaphore gpu_sema: Held while tilt runs so only one job uses the GPU
+
+    :return bool: True if all steps completed successfully
+    """
+    # Run newstack and tilt to generate the aligned tilt series and tomogram, respectively
+    if prog == 2:
+        if not newstack(d, name):
+            logging.error('%s -- Error in newstack. Terminating this dataset...' % d.name)
+            return False
+    with gpu_sema:
+        if not tilt(d, name):
+            logging.error('%s -- Error in tilt. Terminating this dataset...' % d.name)
+            return False
+    if not trimvol(d, name):
+        logging.error('%s -- error in trimvol. Terminating this dataset...' % d.name)
+        return False
+    return True
 
 
 def generate_halfsets(p: Path) -> None:
     """ Generate the half tomograms from even and odd tilts """
     # Begin the processing
     datasets: list[Path] = get_datasets(p)
-    for d in datasets:
-        # Check the metadata
-        prog: int = check_metadata(d)
+    gpu_sema = threading.BoundedSemaphore(1)
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        futures = []
+        for d in datasets:
+            # Basename of the tilt series, shared by all the processing steps
+            name = next(x for x in d.glob(EXT) if 'full' not in x.name).name.split('_rec')[0]
 
-        if prog == 0:
-            raise Exception('Must first transfer data from database and try again')
-        else:
-            # Construct the appropriate coms files
-            construct_coms(d, prog)
+            # Check the metadata
+            prog: int = check_metadata(d, name)
 
-            # Run newstack and tilt to generate the aligned tilt series and tomogram, respectively
-            if prog == 2:
-                if not newstack(d):
-                    logging.error('%s -- Error in newstack. Terminating this dataset...' % d.name)
-                    continue
-            if not tilt(d):
-                logging.error('%s -- Error in tilt. Terminating this dataset...' % d.name)
-                continue
-            if not trimvol(d):
-                logging.error('%s -- error in trimvol. Terminating this dataset...' % d.name)
-                continue
+            if prog == 0:
+                raise Exception('Must first transfer data from database and try again')
+
+            # Construct the appropriate coms files, then process datasets concurrently
+            construct_coms(d, prog, name)
+            futures.append(pool.submit(process_dataset, d, name, prog, gpu_sema))
+
+        for future in as_completed(futures):
+            future.result()
 
 
 def subtransfer(p: Path) -> None:
     """ Move all halfset tomograms into a subdirectory """
-    files_evens = [f for f in p.rglob('*_rec_evens.mrc') if 'full' not in f.name]
-    files_odds = [f for f in p.rglob('*_rec_odds.mrc') if 'full' not in f.name]
+    # Walk the tree once, bucketing the evens and odds by their dataset directory
+    buckets = defaultdict(lambda: {'e': [], 'o': []})
+    for f in p.rglob('*_rec_*.mrc'):
+        if 'full' in f.name or f.parent.name == 'halfsets':
+            continue
+        if f.name.endswith('_rec_evens.mrc'):
+            buckets[f.parent]['e'].append(f)
+        elif f.name.endswith('_rec_odds.mrc'):
+            buckets[f.parent]['o'].append(f)
     
     logger.info('\nTransferring halfset reconstructions into subdirectory "halfsets"')
 
-    for i, f in enumerate(files_evens):
-        subdir = Path(f'{f.parent}/halfsets')
-        Path.mkdir(subdir, exist_ok=True)
+    for parent, files in buckets.items():
+        subdir = parent / 'halfsets'
+        subdir.mkdir(exist_ok=True)
 
-        # Move files with Path.rename()
-        f.rename(subdir / f.name)
-        files_odds[i].rename(subdir / files_odds[i].name)
+        # Move files with os.replace()
+        for src in files['e'] + files['o']:
+            os.replace(str(src), os.path.join(subdir, src.name))
 
     logger.info('Completed transfer of halfset reconstructions into "halfsets" subdirectory')
 
+def find_halfsets(root: str | Path) -> Generator[Path, None, None]:
+    """ Yield every halfsets directory under root, without descending into them """
+    stack = [root]
+    while stack:
+        d = stack.pop()
+        with os.scandir(d) as it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    if e.name == 'halfsets':
+                        yield Path(e.path)
+                    else:
+                        stack.append(e.path)
+
+
 def sync_db(p: Path) -> None:
     """ Sync halfset subdirs with the database S3 location """
-    subdirs = p.rglob('halfsets')
+    subdirs = find_halfsets(p)
     logger.info('\n%s -- Synching the halfset reconstructions to the database' % p.name)
+
+    # Group halfsets by the directory holding their dataset so that each group
+    # can be sent with a single rsync, listing <dataset>/halfsets relative to it
+    groups = defaultdict(list)
     for d in subdirs:
-        src = d.as_posix()
-        subdir = src.split('/')[-2]
-        dest = f'{DB_DIR}/{subdir}'
-
-        if Path(dest).exists():
-            cmd = f'rsync --progress -avhr {src} {dest}'
-            subprocess.run(cmd, shell=True)
-            logger.info('%s -- Finished synching halfset reconstructions to the database' % p.name)
+        subdir = d.parent.name
+        if Path(f'{DB_DIR}/{subdir}').exists():
+            groups[d.parent.parent].append(f'{subdir}/halfsets')
         else:
-            logger.warning('%s -- Does not yet exist in database. Skipping sync to database' % p.name)
+            logger.warning('%s -- Does not yet exist in database. Skipping sync to database' % subdir)
+
+    for root, files in groups.items():
+        cmd = f'rsync --progress -avhr --files-from=- {root.as_posix()}/ {DB_DIR}/'
+        subprocess.run(cmd, shell=True, input='\n'.join(files), text=True)
+        logger.info('%s -- Finished synching halfset reconstructions to the database' % p.name)
 
 
 # Determine if this is running during the pipeline or standalone
@@ -476,7 +553,8 @@ subtransfer(p)
 # At this point, halfsets are generated and moved into the appropriate locations.
 # Setup denoising in a new tmux session
 pyDDW = "/cloud-data/its-cmo-darwin-magellan-workspaces-folders/WS_Cryoem/CX_LMR/Project_directories/cryo-et-pipeline/pyDDW.py"
-cmd = f'tmux send-keys "python {pyDDW} 1 {p.as_posix()}" C-m'
+# pyDDW calls ddw in-process, so it has to be started inside the DDW environment
+cmd = f'tmux send-keys "source activate DDW && python {pyDDW} 1 {p.as_posix()}" C-m'
 subprocess.run(cmd, shell=True)
 
 # Sync to the database S3 location
@@ -11,17 +11,20 @@
 #   Number of files for training
 #   [Optional] Path to parent folder of files
 
+# Must be run from within the DDW environment (i.e. after 'source activate DDW'),
+# since ddw is called directly rather than through a subprocess
+
+from collections import deque
 import contextlib
+import functools
+from importlib.metadata import entry_points
 import logging
 import os
 from pathlib import Path
-import random
-import subprocess
+import re
 import sys
 import time
-from typing import Generator
-
-import yaml
+from typing import Any, Callable, Generator
 
 
 # Setup the logger
@@ -40,10 +43,53 @@ formatter = logging.Formatter(
 
 logger = logging.getLogger(__name__)
 filename = f'{time.strftime("%Y%m%d_%H%M", time.localtime())}_DDW.log'
-handler = logging.FileHandler(filename)
+# Only create the log file once something is logged
+handler = logging.FileHandler(filename, delay=True, encoding='utf-8')
 handler.setFormatter(formatter)
 logger.setLevel(logging.INFO)
 logger.addHandler(handler)
+# Records go to the log file only, rather than also through the root logger's stream handler
+logger.propagate = False
+
+
+# Metric value at the end of a checkpoint name, e.g. 'epoch=9-val_loss=0.123.ckpt'
+_CKPT_RE = re.compile(r'=([-+]?\d*\.?\d+(?:[eE][-+]?\d+)?)\.ckpt$')
+
+# Directories that never hold halfsets, skipped when searching for them
+PRUNE_DIRS = frozenset({'.git', '__pycache__', 'DDW', 'logs'})
+
+# Default values for the config.yaml files, overridden by kwargs to construct_config
+_DEFAULTS = {
+    # Shared
+    'subtomo_size': 96,
+    'mw_angle': 60,
+    'num_workers': 4,
+    'gpu': 0,
+    'seed': 42,
+    'overwrite': True,
+    # Prepare data
+    'mask_files': None,
+    'min_nonzero_mask_fraction_in_subtomo': 0.3,
+    'subtomo_extraction_strides': [64, 80, 80],
+    'val_fraction': 0.2,
+    # Fit model
+    'chans': 64,
+    'num_downsample_layers': 3,
+    'drop_prob': 0.0,
+    'lr': 0.0004,
+    'num_epochs': 1000,
+    'batch_size_fit': 5,
+    'update_subtomo_missing_wedges_every_n_epochs': 10,
+    'check_val_every_n_epochs': 10,
+    'save_n_models_with_lowest_val_loss': 5,
+    'save_n_models_with_lowest_fitting_loss': 5,
+    'save_model_every_n_epochs': 50,
+    'logger': 'csv',
+    # Refine
+    'model_checkpoint_file': None,
+    'subtomo_overlap': 32,
+    'batch_size_refine': 10,
+}
 
 
 @contextlib.contextmanager
@@ -57,11 +103,32 @@ def chdir(path: str | Path) -> Generator[None, None, None]:
         os.chdir(prev_cwd)
 
 
+def _scan_files(
+        root: str | Path, 
+        prune: frozenset[str] | set[str]=PRUNE_DIRS
+    ) -> Generator[os.DirEntry, None, None]:
+    """ 
+    Recursively yield the file entries under root, without building Paths 
+    
+    Directories named in prune, or hidden directories, are not descended into
+    """
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in prune and not entry.name.startswith('.'):
+                        stack.append(entry.path)
+                elif entry.is_file():
+                    yield entry
+
+
 def locate_halfsets(
         p: Path, 
         evens_ext: str='evens', 
         odds_ext: str='odds', 
-        ext: str='mrc'
+        ext: str='mrc',
+        prune: frozenset[str] | set[str]=PRUNE_DIRS
     ) -> tuple[tuple[Path, Path]]:
     """
     Find all the halfsets
@@ -70,17 +137,32 @@ def locate_halfsets(
     :param str evens_ext: Added extension to the evens halfset
     :param str odds_ext: Added extension to the odds halfset
     :param str ext: File extension
+    :param set(str) prune: Names of directories to skip while searching
     
     :return tuple(tuple(Path, Path)): Pairs of halfsets
     :raises FileNotFoundError: If no files found
     """
-    evens = [f for f in p.rglob(f'*{evens_ext}.{ext}') if 'full' not in f.name]
-    odds = [f for f in p.rglob(f'*{odds_ext}.{ext}') if 'full' not in f.name]
-
-    logger.info('Found %d evens and %d odds' % (len(evens), len(odds)))
+    # Single walk of the tree, only wrapping matches in Path
+    ev_suf = f'{evens_ext}.{ext}'
+    od_suf = f'{odds_ext}.{ext}'
+    evens, odds = [], []
+    for entry in _scan_files(p, prune):
+        name = entry.name
+        if 'full' in name:
+            continue
+        if name.endswith(ev_suf):
+            evens.append(Path(entry.path))
+        elif name.endswith(od_suf):
+            odds.append(Path(entry.path))
+
+    # Sort so that each evens lines up with its odds
+    evens.sort()
+    odds.sort()
+
+    logger.info('Found %d evens and %d odds', len(evens), len(odds))
 
     if len(evens) == 0 and len(odds) == 0:
-        logger.error('HALFSETS NOT FOUND WITHIN PATH %s' % p.name)
+        logger.error('HALFSETS NOT FOUND WITHIN PATH %s', p.name)
         raise FileNotFoundError
 
     halfsets = tuple(zip(evens, odds, strict=True))
@@ -96,16 +178,22 @@ def get_random_halfsets(halfsets: tuple[tuple[Path, Path]], n: int=5) -> tuple[t
     
     return tuple(tuple(Path, Path)): pairs of randomly selected halfsets
     """
-    samples = random.sample(range(0, len(halfsets)), n)
-    evens = [halfsets[i][0] for i in samples]
-    odds = [halfsets[i][1] for i in samples]
+    import random
 
-    logger.info('Added to the training set: {}'.format(', '.join([f.name for f in evens])))
-    logger.info('Added to the training set: {}'.format(', '.join([f.name for f in odds])))
-    return tuple(zip(evens, odds))
+    picks = tuple(random.sample(halfsets, n))
+    evens, odds = zip(*picks)
 
+    logger.info('Added to the training set: %s', ', '.join(f.name for f in evens))
+    logger.info('Added to the training set: %s', ', '.join(f.name for f in odds))
+    return picks
 
-def construct_config(p: Path, proc: str, halfsets: tuple[tuple[Path, Path]], **kwargs) -> Path:
+
+def construct_config(
+        p: Path, 
+        proc: str, 
+        halfsets: tuple[tuple[Path, Path]], 
+        **kwargs
+    ) -> tuple[Path, dict]:
     """
     Construct the config files for fitting and refining
 
@@ -114,124 +202,112 @@ def construct_config(p: Path, proc: str, halfsets: tuple[tuple[Path, Path]], **k
     :param tuple(tuple(Path, Path)): Halfset pairs
     :param **kwargs: Additional args for the config.yaml files
 
-    :return Path: config file
+    :return tuple(Path, dict): config file and the config data written to it
     """
     if proc not in ['fit', 'refine']:
         logger.error('VALUE ERROR: When constructing config file, must be either fit or refine')
         raise ValueError
     
     if proc == 'fit':
-        filename = p / Path('fit_config.yaml')
+        filename = p / 'fit_config.yaml'
     elif proc == 'refine':
         assert 'model_checkpoint_file' in kwargs, "Must provide model checkpoint file"
-        assert Path(kwargs['model_checkpoint_file']).exists()
-        filename = p / Path('refine_config.yaml')
+        assert os.path.exists(kwargs['model_checkpoint_file'])
+        filename = p / 'refine_config.yaml'
     
-    # Shared
-    subtomo_size = kwargs['subtomo_size'] if 'subtomo_size' in kwargs else 96
-    mw_angle = kwargs['mw_angle'] if 'mw_angle' in kwargs else 60
-    num_workers = kwargs['num_workers'] if 'num_workers' in kwargs else 4
-    gpu = kwargs['gpu'] if 'gpu' in kwargs else 0
-    seed = kwargs['seed'] if 'seed' in kwargs else 42
-    overwrite = kwargs['overwrite'] if 'overwrite' in kwargs else True
-
-    # Prepare data
-    mask_files = kwargs['mask_files'] if 'mask_files' in kwargs else None
-    min_nonzero_mask_fraction_in_subtomo = (
-        kwargs['min_nonzero_mask_fraction_in_subtomo'] 
-        if 'min_nonzero_mask_fraction_in_subtomo' in kwargs else 0.3
-    )
-    subtomo_extraction_strides = (
-        kwargs['subtomo_extraction_strides'] 
-        if 'subtomo_extraction_strides' in kwargs else [64, 80, 80]
-    )
-    val_fraction = kwargs['val_fraction'] if 'val_fraction' in kwargs else 0.2
-
-    # Fit model
-    unet_params_dict = {
-        'chans': kwargs['chans'] if 'chans' in kwargs else 64,
-        'num_downsample_layers': kwargs['num_downsample_layers'] if 'num_downsample_layers' in kwargs else 3,
-        'drop_prob': kwargs['drop_prob'] if 'drop_prob' in kwargs else 0.0
-    }
-    adam_params_dict = {
-        'lr': kwargs['lr'] if 'lr' in kwargs else 0.0004
-    }
-    num_epochs = kwargs['num_epochs'] if 'num_epochs' in kwargs else 1000
-    batch_size_fit = kwargs['batch_size_fit'] if 'batch_size_fit' in kwargs else 5
-    update_subtomo_missing_wedges_every_n_epochs = (
-        kwargs['update_subtomo_missing_wedges_every_n_epochs']
-        if 'update_subtomo_missing_wedges_every_n_epochs' in kwargs else 10
-    )
-    check_val_every_n_epochs = (
-        kwargs['check_val_every_n_epochs'] if 'check_val_every_n_epochs' in kwargs
-        else 10
-    )
-    save_n_models_with_lowest_val_loss = (
-        kwargs['save_n_models_with_lowest_val_loss']
-        if 'save_n_models_with_lowest_val_loss' in kwargs else 5
-    )
-    save_n_models_with_lowest_fitting_loss = (
-        kwargs['save_n_models_with_lowest_fitting_loss'] 
-        if 'save_n_models_with_lowest_fitting_loss' in kwargs else 5
-    )
-    save_model_every_n_epochs = (
-        kwargs['save_model_every_n_epochs'] if 'save_model_every_n_epochs' in kwargs
-        else 50
-    )
-    model_logger = kwargs['logger'] if 'logger' in kwargs else "csv"
-
-    # Refine
-    model_checkpoint_file = kwargs['model_checkpoint_file'] if 'model_checkpoint_file' in kwargs else None
-    subtomo_overlap = kwargs['subtomo_overlap'] if 'subtomo_overlap' in kwargs else 32
-    batch_size_refine = kwargs['batch_size_refine'] if 'batch_size_refine' in kwargs else 10
+    cfg = {**_DEFAULTS, **kwargs}
 
     # Split halfsets into evens and odds
-    tomo_0_files, tomo_1_files = zip(*halfsets)
+    tomo_0_files, tomo_1_files = [], []
+    as_posix = Path.as_posix
+    for e, o in halfsets:
+        tomo_0_files.append(as_posix(e))
+        tomo_1_files.append(as_posix(o))
 
     # Construct the file data
     conf = {
         'shared': {
             'project_dir': (p / 'DDW').as_posix(),
-            'tomo0_files': [f.as_posix() for f in tomo_0_files],
-            'tomo1_files': [f.as_posix() for f in tomo_1_files],
-            'subtomo_size': subtomo_size,
-            'mw_angle': mw_angle,
-            'num_workers': num_workers,
-            'gpu': gpu,
-            'seed': seed,
-            'overwrite': overwrite
+            'tomo0_files': tomo_0_files,
+            'tomo1_files': tomo_1_files,
+            'subtomo_size': cfg['subtomo_size'],
+            'mw_angle': cfg['mw_angle'],
+            'num_workers': cfg['num_workers'],
+            'gpu': cfg['gpu'],
+            'seed': cfg['seed'],
+            'overwrite': cfg['overwrite']
         },
         'prepare_data': {
-            'mask_files': mask_files,
-            'min_nonzero_mask_fraction_in_subtomo': min_nonzero_mask_fraction_in_subtomo,
-            'subtomo_extraction_strides': subtomo_extraction_strides,
-            'val_fraction': val_fraction
+            'mask_files': cfg['mask_files'],
+            'min_nonzero_mask_fraction_in_subtomo': cfg['min_nonzero_mask_fraction_in_subtomo'],
+            'subtomo_extraction_strides': list(cfg['subtomo_extraction_strides']),
+            'val_fraction': cfg['val_fraction']
         },
         'fit_model': {
-            'unet_params_dict': unet_params_dict,
-            'adam_params_dict': adam_params_dict,
-            'num_epochs': num_epochs,
-            'batch_size': batch_size_fit,
-            'update_subtomo_missing_wedges_every_n_epochs': update_subtomo_missing_wedges_every_n_epochs,
-            'check_val_every_n_epochs': check_val_every_n_epochs,
-            'save_n_models_with_lowest_val_loss': save_n_models_with_lowest_val_loss,
-            'save_n_models_with_lowest_fitting_loss': save_n_models_with_lowest_fitting_loss,
-            'save_model_every_n_epochs': save_model_every_n_epochs,
-            'logger': model_logger
+            'unet_params_dict': {
+                'chans': cfg['chans'],
+                'num_downsample_layers': cfg['num_downsample_layers'],
+                'drop_prob': cfg['drop_prob']
+            },
+            'adam_params_dict': {
+                'lr': cfg['lr']
+            },
+            'num_epochs': cfg['num_epochs'],
+            'batch_size': cfg['batch_size_fit'],
+            'update_subtomo_missing_wedges_every_n_epochs': cfg['update_subtomo_missing_wedges_every_n_epochs'],
+            'check_val_every_n_epochs': cfg['check_val_every_n_epochs'],
+            'save_n_models_with_lowest_val_loss': cfg['save_n_models_with_lowest_val_loss'],
+            'save_n_models_with_lowest_fitting_loss': cfg['save_n_models_with_lowest_fitting_loss'],
+            'save_model_every_n_epochs': cfg['save_model_every_n_epochs'],
+            'logger': cfg['logger']
         },
         'refine_tomogram': {
-            'model_checkpoint_file': model_checkpoint_file,
-            'subtomo_overlap': subtomo_overlap,
-            'batch_size': batch_size_refine
+            'model_checkpoint_file': cfg['model_checkpoint_file'],
+            'subtomo_overlap': cfg['subtomo_overlap'],
+            'batch_size': cfg['batch_size_refine']
         }
     }
 
     # Save the YAML file
+    import yaml
+    try:
+        from yaml import CSafeDumper as SafeDumper
+    except ImportError:
+        # libyaml not available, use the pure Python dumper
+        from yaml import SafeDumper
+
     with open(filename, 'w') as f:
-        yaml.safe_dump(conf, f, sort_keys=False)
+        yaml.dump(conf, f, Dumper=SafeDumper, sort_keys=False, default_flow_style=False)
+
+    logger.info('Saved config file %s', filename)
+    return filename, conf
+
 
-    logger.info('Saved config file %s' % filename)
-    return Path(filename)
+def _pick_ckpt(p: Path, subdir: str, reverse: bool=False) -> Path:
+    """
+    Pick the checkpoint with the lowest (or highest) metric in the last matching subdir
+
+    :param Path p: project directory
+    :param str subdir: Checkpoint subdirectory name, e.g. 'val_loss'
+    :param bool reverse: Pick the highest value instead of the lowest
+
+    :return Path: Path to the checkpoint
+    """
+    last = deque(p.rglob(subdir), maxlen=1)
+    if not last:
+        logger.error('NO %s CHECKPOINT DIRECTORY FOUND WITHIN PATH %s', subdir, p)
+        raise FileNotFoundError
+    # Filter on the directory entries and only build a Path for the winner.
+    # Checkpoints without a metric in their name (e.g. last.ckpt) are skipped
+    with os.scandir(last[0]) as it:
+        scored = [
+            (float(m.group(1)), e.path) for e in it 
+            if e.name.endswith('.ckpt') and (m := _CKPT_RE.search(e.name))
+        ]
+    if not scored:
+        logger.error('NO SCORED CHECKPOINTS FOUND WITHIN %s', last[0])
+        raise FileNotFoundError
+    return Path((max if reverse else min)(scored, key=lambda s: s[0])[1])
 
 
 def get_best_model(p: Path, mode: str='val') -> Path:
@@ -246,37 +322,43 @@ def get_best_model(p: Path, mode: str='val') -> Path:
     assert mode in ['val', 'fit', 'latest']
 
     if mode == 'val':
-        d = list(p.rglob('val_loss'))
-        d = d[-1] if len(d) > 1 else d[0]
-        ckpts = [x for x in d.iterdir() if x.suffix == '.ckpt']
-        loss = [float(x.name.split('=')[-1].split('.ckpt')[0]) for x in ckpts]
-        best = sorted(tuple(zip(loss, ckpts)))[0][1]
+        best = _pick_ckpt(p, 'val_loss')
+        logger.info('Identified best model by validation loss -- %s', best.name)
+    elif mode == 'fit':
+        best = _pick_ckpt(p, 'fitting_loss')
+        logger.info('Identified best model by fitting loss -- %s', best.name)
+    else:
+        # By latest epoch
+        best = _pick_ckpt(p, 'epoch', reverse=True)
+        logger.info('Identified model by latest epoch -- %s', best.name)
 
-        logger.info('Identified best model by validation loss -- %s' % best.name)
+    return best
 
-        return best
-    elif mode == 'fit':
-        d = list(p.rglob('fitting_loss'))
-        d = d[-1] if len(d) > 1 else d[0]
-        ckpts = [x for x in d.iterdir() if x.suffix == '.ckpt']
-        loss = [float(x.name.split('=')[-1].split('.ckpt')[0]) for x in ckpts]
-        best = sorted(tuple(zip(loss, ckpts)))[0][1]
 
-        logger.info('Identified best model by fitting loss -- %s' % best.name)
+@functools.cache
+def _ddw_cli() -> Callable[..., Any]:
+    """ Load the ddw console-script entry point once, so every step shares it """
+    eps = entry_points(group='console_scripts', name='ddw')
+    if not eps:
+        logger.error('ddw NOT FOUND. pyDDW must be run inside the DDW environment')
+        raise ImportError("ddw is not installed in this environment. Run 'source activate DDW' first")
+    return next(iter(eps)).load()
 
-        return best
-    else:
-        # By lates epoch
-        d = list(p.rglob('epoch'))
-        d = d[-1] if len(d) > 1 else d[0]
-        ckpts = [x for x in d.iterdir() if x.suffix == '.ckpt']
-        loss = [float(x.name.split('=')[-1].split('.ckpt')[0]) for x in ckpts]
-        best = sorted(tuple(zip(loss, ckpts)), reverse=True)[0][1]
 
-        logger.info('Identified model by latest epoch -- %s' % best.name)
+def run_ddw(command: str, config: Path) -> None:
+    """
+    Run a ddw subcommand inside this process, i.e. 'ddw <command> --config ./config.yaml'
 
-        return best
+    Every step runs in the same interpreter through the same loaded CLI, so torch
+    and the CUDA context initialized by fit are reused by refine
 
+    :param str command: ddw subcommand, e.g. 'fit-model'
+    :param Path config: Path to config.yaml file
+    """
+    # Without standalone mode, a non-zero exit from ddw is returned rather than raised
+    result = _ddw_cli()(args=[command, '--config', str(config)], standalone_mode=False)
+    if isinstance(result, int) and not isinstance(result, bool) and result != 0:
+        raise RuntimeError(f'ddw {command} exited with code {result}')
 
 
 def prepare(config: Path) -> None:
@@ -288,10 +370,11 @@ def prepare(config: Path) -> None:
     assert config.exists()
     logger.info('\nBEGINNING TO PREPARE THE DATA')
 
-    cmd = f'source activate DDW && ddw prepare-data --config {config}'
-    if (exit_code := subprocess.run(cmd, shell=True).returncode) != 0:
-        logger.error('Error in data preparation. Return code %d' % exit_code)
-        sys.exit(exit_code)
+    try:
+        run_ddw('prepare-data', config)
+    except Exception:
+        logger.exception('Error in data preparation')
+        raise
 
     logger.info('COMPLETED PREPARING DATA')
 
@@ -305,10 +388,11 @@ def fit(config: Path) -> None:
     assert config.exists()
     logger.info('\nBEGINNING FIT-MODEL')
 
-    cmd = f'source activate DDW && ddw fit-model --config {config}'
-    if (exit_code := subprocess.run(cmd, shell=True).returncode) != 0:
-        logger.error('Error in model fitting. Return code %d' % exit_code)
-        sys.exit(exit_code)
+    try:
+        run_ddw('fit-model', config)
+    except Exception:
+        logger.exception('Error in model fitting')
+        raise
     
     logger.info('TRAINING COMPLETE!')
 
@@ -324,43 +408,41 @@ def refine(config: Path) -> None:
 
     logger.info('\nBEGINNING TO REGINE ALL TOMOGRAMS')
 
-    cmd = f'source activate DDW && ddw refine-tomogram --config {config}'
-    if (exit_code := subprocess.run(cmd, shell=True).returncode) != 0:
-        logger.error('Error in refining the tomograms. Return code %d' % exit_code)
-        sys.exit(exit_code)
+    try:
+        run_ddw('refine-tomogram', config)
+    except Exception:
+        logger.exception('Error in refining the tomograms')
+        raise
 
     logger.info('REFINEMENT COMPLETE')
     
 
-# Determine if this is running during the pipeline or standalone
-if len(sys.argv) < 2:
-    raise ValueError("Not enough arguments. Add '1' if running during the pipeline, '0' if running standalone.")
-RUNNING_PIPELINE = sys.argv[1]
-
-if len(sys.argv) == 2:
-    p = Path.cwd()
-elif len(sys.argv) == 3:
-    p = Path(sys.argv[2])
-    assert p.exists(), f"Given path {p} does not exist"
-    assert p.is_dir(), f"Given path {p} is not a valid directory"
-
-# For now, just choose randomly for training among the datasets for prototyping
-halfsets = locate_halfsets(p)
-training_sets = get_random_halfsets(halfsets)
-
-# Prepare data and fit model
-config_file = construct_config(p, 'fit', training_sets)
-# prepare(config=config_file)
-fit(config=config_file)
-
-# Refine the tomograms
-with open(config_file, 'r') as f:
-    config_data = yaml.safe_load(f)
-proj_dir = Path(config_data['shared']['project_dir'])
-proj_dir = Path('/common/workdir/DDW_test')
-model = get_best_model(proj_dir, mode='val').as_posix()
-config_file = construct_config(p, 'refine', halfsets, model_checkpoint_file=model)
-refine(config=config_file)
-
-# Sync to proper workdir location and to database S3 location
-
+if __name__ == '__main__':
+    # Determine if this is running during the pipeline or standalone
+    if len(sys.argv) < 2:
+        raise ValueError("Not enough arguments. Add '1' if running during the pipeline, '0' if running standalone.")
+    RUNNING_PIPELINE = sys.argv[1]
+
+    if len(sys.argv) == 2:
+        p = Path.cwd()
+    elif len(sys.argv) == 3:
+        p = Path(sys.argv[2])
+        assert p.exists(), f"Given path {p} does not exist"
+        assert p.is_dir(), f"Given path {p} is not a valid directory"
+
+    # For now, just choose randomly for training among the datasets for prototyping
+    halfsets = locate_halfsets(p)
+    training_sets = get_random_halfsets(halfsets)
+
+    # Prepare data and fit model
+    config_file, config_data = construct_config(p, 'fit', training_sets)
+    # prepare(config=config_file)
+    fit(config=config_file)
+
+    # Refine the tomograms
+    proj_dir = Path(config_data['shared']['project_dir'])
+    model = get_best_model(proj_dir, mode='val').as_posix()
+    config_file, _ = construct_config(p, 'refine', halfsets, model_checkpoint_file=model)
+    refine(config=config_file)
+
+    # Sync to proper workdir location and to database S3 location